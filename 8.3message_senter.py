@@ -1,8 +1,25 @@
 import asyncio
 import aiohttp
+import os
 import time
 import random
 import uuid
+import re
+import json
+import copy
+import hashlib
+import sqlite3
+import threading
+from itertools import (
+    count,
+    islice,
+)
+import heapq
+from bisect import bisect_right
+from collections import (
+    OrderedDict,
+    deque,
+)
 from dataclasses import (
     dataclass,
     field,
@@ -12,27 +29,417 @@ from logger_config import setup_logging
 
 logger = logging.getLogger(__name__)
 
+API_URL = "https://api.openai.com/v1/chat/completions"
+WARM_UP_URL = "https://api.openai.com/v1/models"  # 预热连接用，不带 key 也会很快返回
+PROXY = "http://127.0.0.1:7890"
+DEFAULT_MAX_TOKENS = 1024  # 请求里没有 max_tokens 时按这个值预留
+
+# 等待 key 的优先级，数字越小越优先；同一优先级内按截止时间先后（EDF）分配
+PRIORITY_INTERACTIVE = 0  # 在线调用，要求低延迟
+PRIORITY_BATCH = 1  # 批量任务，只用在线调用剩下的额度
+DEFAULT_TENANT = 'default'  # 没有指定租户的请求都算在这里
+
+
+def estimate_token_cost(request_json):
+    """粗略估算一次请求会占用的 token 数：提示词 + max_tokens * n。
+
+    提示词按每 4 个字符约 1 个 token 估算，每条消息再加上固定的格式开销。
+    """
+    prompt_tokens = 3
+    for message in request_json.get('messages', []):
+        prompt_tokens += 4
+        for value in message.values():
+            if isinstance(value, str):
+                prompt_tokens += len(value) // 4 + 1
+    max_tokens = request_json.get('max_tokens') or DEFAULT_MAX_TOKENS
+    return prompt_tokens + max_tokens * request_json.get('n', 1)
+
+
+def parse_reset_duration(value):
+    """把 x-ratelimit-reset-* 里的 "6m0s"、"20ms"、"1h2m3.5s" 转成秒数。"""
+    units = {'h': 3600, 'm': 60, 's': 1, 'ms': 0.001}
+    seconds = 0.0
+    for number, unit in re.findall(r'(\d+(?:\.\d+)?)(ms|h|m|s)', value or ''):
+        seconds += float(number) * units[unit]
+    return seconds
+
+
+def parse_retry_after(headers):
+    """读取 retry-after-ms / retry-after 头，返回秒数，没有或无法解析时返回 None。"""
+    try:
+        if 'retry-after-ms' in headers:
+            return float(headers['retry-after-ms']) / 1000
+        if 'retry-after' in headers:
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+# 错误分类，每一类有自己的重试策略
+RATE_LIMIT = 'rate_limit'  # 429，请求过快
+QUOTA = 'quota'  # 429，额度用完（insufficient_quota）
+KEY_ERROR = 'key'  # 401/403，key 无效或账号被停用，换一个 key 就能成功
+SERVER = 'server'  # 5xx
+TIMEOUT = 'timeout'
+CONNECTION = 'connection'  # 连接被重置、断开等
+FATAL = 'fatal'  # 其他 4xx，请求本身有问题，重试也不会成功
+OTHER = 'other'
+
+QUOTA_SUSPEND_SECONDS = 3600  # 额度用完的 key 暂停使用的时间
+KEY_ERROR_SUSPEND_SECONDS = 24 * 3600  # 无效的 key 暂停使用的时间
+
+
+class DeadlineExceeded(asyncio.TimeoutError):
+    """请求没能在调用方给出的截止时间前完成。"""
+
+
+class Overloaded(RuntimeError):
+    """排队等 key 的时间预计超过上限，请求没有被接受。
+
+    estimated_wait 是当时估算的排队时间（秒），调用方可以据此稍后再试。
+    """
+
+    def __init__(self, message, estimated_wait):
+        super().__init__(message)
+        self.estimated_wait = estimated_wait
+
+
+@dataclass
+class RetryPolicy:
+    retry: bool = True
+    base_delay: float = 1
+    max_delay: float = 30
+
+
+RETRY_POLICIES = {
+    RATE_LIMIT: RetryPolicy(base_delay=1, max_delay=60),
+    # 额度用完的 key 会被暂停，马上换一个 key 重试
+    QUOTA: RetryPolicy(base_delay=0, max_delay=0),
+    KEY_ERROR: RetryPolicy(base_delay=0, max_delay=0),
+    SERVER: RetryPolicy(base_delay=1, max_delay=30),
+    TIMEOUT: RetryPolicy(base_delay=1, max_delay=30),
+    CONNECTION: RetryPolicy(base_delay=0.5, max_delay=10),
+    FATAL: RetryPolicy(retry=False),
+    OTHER: RetryPolicy(base_delay=1, max_delay=30),
+}
+
+
+def classify_response_error(status, body):
+    error = body.get('error') if isinstance(body, dict) else None
+    error = error if isinstance(error, dict) else {}
+    if status == 429 or error.get('code') in ('rate_limit_exceeded',
+                                                'insufficient_quota'):
+        if error.get('code') == 'insufficient_quota' or error.get(
+                'type') == 'insufficient_quota' or 'quota' in error.get(
+                    'message', ''):
+            return QUOTA
+        return RATE_LIMIT
+    if status in (401, 403) or error.get('code') in ('invalid_api_key',
+                                                      'account_deactivated'):
+        return KEY_ERROR
+    if status >= 500:
+        return SERVER
+    if 400 <= status < 500:
+        return FATAL
+    if 'Rate limit' in error.get('message', ''):
+        return RATE_LIMIT
+    return OTHER
+
+
+def classify_exception(e):
+    # aiohttp 的超时异常也是 asyncio.TimeoutError 的子类
+    if isinstance(e, asyncio.TimeoutError):
+        return TIMEOUT
+    if isinstance(e, (aiohttp.ClientConnectionError, ConnectionError)):
+        return CONNECTION
+    return OTHER
+
+
+def apply_rate_limit_headers(bucket, headers):
+    """根据 x-ratelimit-* 响应头校准 bucket 上的请求数桶和 TPM 桶。
+
+    容量取服务端给出的 limit，补充速度按 "用掉的额度 / 距离重置的时间" 计算，
+    当前令牌数不会超过服务端报告的 remaining。
+    """
+    for kind, capacity_attr, rate_attr, tokens_attr in (
+        ('requests', 'bucket_capacity', 'refill_rate', 'tokens'),
+        ('tokens', 'tpm_capacity', 'tpm_refill_rate', 'tpm_tokens'),
+    ):
+        try:
+            limit = int(headers[f'x-ratelimit-limit-{kind}'])
+            remaining = int(headers[f'x-ratelimit-remaining-{kind}'])
+        except (KeyError, ValueError):
+            continue
+        if limit <= 0:
+            continue
+        reset = parse_reset_duration(headers.get(f'x-ratelimit-reset-{kind}'))
+        if remaining < limit and reset > 0:
+            refill_rate = (limit - remaining) / reset
+        else:
+            refill_rate = limit / 60
+        setattr(bucket, capacity_attr, limit)
+        setattr(bucket, rate_attr, refill_rate)
+        setattr(bucket, tokens_attr, min(getattr(bucket, tokens_attr),
+                                         remaining))
+        logger.debug(
+            f'{bucket.id} 校准{kind}限额：limit={limit}, remaining={remaining}, refill_rate={refill_rate:.3f}/s'
+        )
+
+
+def load_session_configs(file_path):
+    """读取 key 文件，生成 SessionManager 需要的 session_configs。
+
+    既支持每行一个 key 的 api keys.txt，也支持 api_filter 输出的 "key---org" 格式，
+    后者会把组织 id 写进 config['org_id']，同组织的 key 共享一个限额桶。
+    """
+    session_configs = []
+    with open(file_path, 'r') as file:
+        for line in file.read().splitlines():
+            if not line.strip():
+                continue
+            api_key, _, org_id = line.strip().partition('---')
+            config = {
+                "headers": {
+                    "Authorization": f"Bearer {api_key}",
+                    "Content-Type": "application/json"
+                }
+            }
+            # succeed / other / No match found 不是组织 id，这些 key 各自独立
+            if re.fullmatch(r'[A-Za-z0-9]+', org_id) and org_id not in (
+                    'succeed', 'other'):
+                config['org_id'] = f'org-{org_id}'
+            session_configs.append(config)
+    return session_configs
+
+
+@dataclass
+class OrgBucket:
+    """同一个组织下所有 key 共享的限额桶。
+
+    OpenAI 按组织计算限额，同组织的 key 之间轮换并不能绕开限流，
+    所以每个 key 发请求前除了自己的桶，还要从所属组织的桶里拿到令牌。
+    """
+    id: str
+    bucket_capacity: int = 3
+    refill_rate: float = 1 / 20
+    tokens: float = 3
+    tpm_capacity: int = 40000
+    tpm_refill_rate: float = 40000 / 60
+    tpm_tokens: float = 40000
+    last_refill: float = field(default_factory=time.time)
+
+    def refill_tokens(self):
+        now = time.time()
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.tokens = min(self.bucket_capacity,
+                          self.tokens + elapsed * self.refill_rate)
+        self.tpm_tokens = min(self.tpm_capacity,
+                              self.tpm_tokens + elapsed * self.tpm_refill_rate)
+
+    def next_available_at(self, cost=0):
+        ready_at = self.last_refill
+        if self.tokens < 1:
+            ready_at += (1 - self.tokens) / self.refill_rate
+        cost = min(cost, self.tpm_capacity)
+        if self.tpm_tokens < cost:
+            ready_at = max(
+                ready_at, self.last_refill +
+                (cost - self.tpm_tokens) / self.tpm_refill_rate)
+        return ready_at
+
+    def has_room(self, cost=0):
+        return self.tokens >= 1 and self.tpm_tokens >= min(
+            cost, self.tpm_capacity)
+
+    def consume(self, cost=0):
+        self.tokens -= 1
+        self.tpm_tokens -= min(cost, self.tpm_capacity)
+
+    def give_back(self, cost=0):
+        self.tokens = min(self.bucket_capacity, self.tokens + 1)
+        self.refund_tpm(cost)
+
+    def refund_tpm(self, amount):
+        self.tpm_tokens = min(self.tpm_capacity, self.tpm_tokens + amount)
+
+    def hold_off(self, retry_after):
+        self.tokens = min(self.tokens, 1 - retry_after * self.refill_rate)
+
+
+@dataclass
+class ConnectionPool:
+    """所有 key 共用的连接池。
+
+    每个 key 各建一个 ClientSession 时，每个 session 都有自己的 connector，
+    对同一个 host 要各自握手、各自保持长连接。共用一个 TCPConnector 后，
+    连接数只取决于并发量，Authorization 头改为在每个请求上单独发送。
+    """
+    limit: int = 100
+    limit_per_host: int = 0  # 0 表示不单独限制每个 host
+    keepalive_timeout: float = 30
+    ttl_dns_cache: int = 300
+    timeout: float = 30
+    read_timeout: float = 120  # 两次读到数据之间的最长间隔，接口卡住时不会一直挂着
+    total_timeout: float = 600  # 单次请求（含排队等连接）的总时长上限
+    _session: aiohttp.ClientSession = field(default=None, init=False)
+
+    def get_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.ttl_dns_cache,
+                use_dns_cache=True,
+            )
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=self.total_timeout,
+                                              connect=self.timeout,
+                                              sock_read=self.read_timeout))
+        return self._session
+
+    async def warm_up(self, connections, url=WARM_UP_URL, proxy=PROXY):
+        """提前建立 connections 个长连接（DNS、TCP、代理 CONNECT、TLS），放回池里复用。
+
+        请求是同时发出的，所以每个请求都会占用一个单独的连接。
+        """
+        if self.limit:
+            connections = min(connections, self.limit)
+        session = self.get_session()
+
+        async def open_connection():
+            try:
+                async with session.get(url, proxy=proxy) as response:
+                    await response.read()
+                return True
+            except Exception as e:
+                logger.warning(f'预热连接失败：{e}')
+                return False
+
+        started = time.time()
+        results = await asyncio.gather(
+            *(open_connection() for _ in range(connections)))
+        logger.info(
+            f'预热了{sum(results)}/{connections}个连接，耗时{time.time() - started:.2f}秒'
+        )
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            logger.info('共享连接池正在关闭')
+            await self._session.close()
+
+
+@dataclass
+class ProxyState:
+    """单个代理的健康状况：并发连接数、延迟和错误率的指数滑动平均，以及被剔除到什么时候。"""
+    url: str  # None 表示直连
+    max_connections: int = 50
+    in_flight: int = 0
+    ewma_latency: float = 1.0
+    error_rate: float = 0.0
+    ejected_until: float = 0
+    eject_count: int = 0
+
+    def is_admitted(self, now):
+        return now >= self.ejected_until
+
+    def score(self):
+        # 越小越好：延迟越低、越空闲、错误越少的代理越优先
+        return self.ewma_latency * (self.in_flight + 1) / max(
+            1 - self.error_rate, 0.01)
+
+
+@dataclass
+class ProxyPool:
+    """多个出口代理组成的代理池。
+
+    每个代理有自己的并发上限，按延迟和错误率打分选择；错误率超过 eject_error_rate 时
+    剔除一段时间（连续剔除时时间翻倍），到期后自动重新加入，再次出错会再被剔除。
+    """
+    urls: list
+    max_connections_per_proxy: int = 50
+    alpha: float = 0.2  # 滑动平均的权重
+    eject_error_rate: float = 0.5
+    eject_seconds: float = 30
+    max_eject_seconds: float = 600
+    proxies: list = field(init=False)
+    _released: asyncio.Event = field(default_factory=asyncio.Event,
+                                     init=False)
+
+    def __post_init__(self):
+        self.proxies = [
+            ProxyState(url or None, self.max_connections_per_proxy)
+            for url in self.urls
+        ]
+
+    def _pick(self, preferred=None):
+        now = time.time()
+        candidates = [
+            proxy for proxy in self.proxies if proxy.is_admitted(now)
+        ]
+        if not candidates:
+            # 全部被剔除时不至于完全停摆，用最早恢复的那个
+            candidates = [min(self.proxies, key=lambda p: p.ejected_until)]
+        candidates = [
+            proxy for proxy in candidates
+            if proxy.in_flight < proxy.max_connections
+        ]
+        for proxy in candidates:
+            if proxy.url == preferred:
+                return proxy
+        if not candidates:
+            return None
+        return min(candidates, key=ProxyState.score)
+
+    async def acquire(self, preferred=None):
+        """选一个代理并占用它的一个连接名额；所有代理都满了就等到有请求释放。"""
+        while (proxy := self._pick(preferred)) is None:
+            self._released.clear()
+            await self._released.wait()
+        proxy.in_flight += 1
+        return proxy
+
+    def release(self, proxy, latency, ok):
+        proxy.in_flight -= 1
+        self._released.set()
+        if ok is None:
+            return
+        proxy.ewma_latency += self.alpha * (latency - proxy.ewma_latency)
+        proxy.error_rate += self.alpha * ((0 if ok else 1) - proxy.error_rate)
+        if ok:
+            proxy.eject_count = 0
+        elif proxy.error_rate > self.eject_error_rate and proxy.is_admitted(
+                time.time()):
+            proxy.eject_count += 1
+            eject_seconds = min(self.max_eject_seconds,
+                                self.eject_seconds * 2**(proxy.eject_count - 1))
+            proxy.ejected_until = time.time() + eject_seconds
+            # 重新加入时从一半的阈值开始，连续失败几次就会再次被剔除
+            proxy.error_rate = self.eject_error_rate / 2
+            logger.warning(
+                f'代理{proxy.url}错误率过高，剔除{eject_seconds:.0f}秒')
+
 
 @dataclass
 class IterCycle:
-    items: list = field(default_factory=list)
-    index: int = 0
+    # 用 OrderedDict 做环，按 id 索引，删除和轮转都是 O(1)
+    items: OrderedDict = field(default_factory=OrderedDict)
+
+    def __post_init__(self):
+        if not isinstance(self.items, OrderedDict):
+            self.items = OrderedDict((item.id, item) for item in self.items)
 
     def add(self, item):
-        self.items.append(item)
+        self.items[item.id] = item
 
     def remove(self, item):
-        if item in self.items:
-            item_index = self.items.index(item)
-            self.items.remove(item)
-            # 如果移除的元素在当前索引之前或者是当前索引，需要调整索引
-            if item_index <= self.index:
-                self.index -= 1
-            # 检查列表是否为空，以避免 ZeroDivisionError
-            if len(self.items) == 0:
-                self.index = 0
-            else:
-                self.index %= len(self.items)
+        self.items.pop(item.id, None)
+
+    def __contains__(self, item):
+        return item.id in self.items
 
     def count_items(self):
         return len(self.items)
@@ -43,11 +450,70 @@ class IterCycle:
     def __next__(self):
         if not self.items:
             raise StopIteration
-        item = self.items[self.index]
-        self.index = (self.index + 1) % len(self.items)
+        item_id, item = next(iter(self.items.items()))
+        self.items.move_to_end(item_id)
         return item
 
 
+@dataclass
+class TenantQueue:
+    """一个租户在某个优先级下等待 key 的请求，小顶堆，截止时间早的在前。"""
+    name: str
+    weight: float = 1
+    deficit: float = 0  # DRR 中还能发送的 token 额度
+    waiters: list = field(default_factory=list)  # (deadline, 序号, future, cost)
+
+    def head(self):
+        # 顺便丢掉已经取消或超时的请求
+        while self.waiters and self.waiters[0][2].done():
+            heapq.heappop(self.waiters)
+        return self.waiters[0] if self.waiters else None
+
+
+@dataclass
+class SessionScheduler:
+    """按"下一个令牌可用时间"排序的小顶堆，选 key 和更新 key 都是 O(log n)。
+
+    更新某个 key 时不在堆里查找旧条目，而是把旧条目标记为失效，弹出时跳过。
+    """
+    _heap: list = field(default_factory=list)
+    _entries: dict = field(default_factory=dict)
+    _counter: int = 0
+
+    def push(self, managed_session, ready_at):
+        self.remove(managed_session)
+        self._counter += 1
+        entry = [ready_at, self._counter, managed_session, True]
+        self._entries[managed_session.id] = entry
+        heapq.heappush(self._heap, entry)
+
+    def remove(self, managed_session):
+        entry = self._entries.pop(managed_session.id, None)
+        if entry is not None:
+            entry[-1] = False
+
+    def _discard_stale(self):
+        while self._heap and not self._heap[0][-1]:
+            heapq.heappop(self._heap)
+
+    def peek_ready_at(self):
+        self._discard_stale()
+        if not self._heap:
+            return None
+        return self._heap[0][0]
+
+    def pop_ready(self, now):
+        self._discard_stale()
+        if not self._heap or self._heap[0][0] > now:
+            return None
+        _, _, managed_session, _ = heapq.heappop(self._heap)
+        del self._entries[managed_session.id]
+        return managed_session
+
+    def __len__(self):
+        return len(self._entries)
+
+
 @dataclass
 class ManagedSession:
     config: dict
@@ -57,19 +523,107 @@ class ManagedSession:
     refill_rate: float = 1 / 20
     tokens: float = 3
     last_used: float = field(default_factory=time.time)
+    last_refill: float = field(default_factory=time.time)
+    # 每分钟 token 数（TPM）的令牌桶，和上面的请求数桶同时满足才能发请求
+    tpm_capacity: int = 40000
+    tpm_refill_rate: float = 40000 / 60
+    tpm_tokens: float = 40000
+    # AIMD：成功时加性增加并发上限和补充速度，遇到 429 时乘性减少。
+    # refill_rate 会被响应头校准覆盖，所以补充速度的调整记在 rate_factor 上，
+    # 实际补充速度 = refill_rate * rate_factor，校准之后调整依然有效
+    in_flight: int = 0
+    max_in_flight: float = 3
+    min_in_flight: int = 1
+    max_in_flight_ceiling: int = 64
+    rate_factor: float = 1.0
+    aimd_rate_step: float = 1 / 30  # 每次成功 rate_factor 增加的量
+    max_rate_factor: float = 2.0
+    aimd_backoff: float = 0.5
+    min_refill_rate: float = 1 / 600
+    org_bucket: OrgBucket = None
+    pool: ConnectionPool = None  # 设置后使用共享连接池，不再单独创建 session
 
     def refill_tokens(self):
         now = time.time()
-        elapsed = now - self.last_used
+        # 按上次补充的时间计算，避免多次调用时重复累加
+        elapsed = now - self.last_refill
+        self.last_refill = now
         self.tokens = min(self.bucket_capacity,
-                          self.tokens + elapsed * self.refill_rate)
+                          self.tokens + elapsed * self.effective_refill_rate)
+        self.tpm_tokens = min(self.tpm_capacity,
+                              self.tpm_tokens + elapsed * self.tpm_refill_rate)
         logger.debug(
-            f'managed_session:{self.id} Refill tokens to >> {self.tokens:.2f}')
+            f'managed_session:{self.id} Refill tokens to >> {self.tokens:.2f}, tpm >> {self.tpm_tokens:.0f}'
+        )
+        if self.org_bucket is not None:
+            self.org_bucket.refill_tokens()
+
+    @property
+    def effective_refill_rate(self):
+        return max(self.min_refill_rate, self.refill_rate * self.rate_factor)
+
+    def next_available_at(self, cost=0):
+        """两个桶都够用的时间点，只做计算，不修改状态。"""
+        ready_at = self.last_refill
+        if self.tokens < 1:
+            ready_at += (1 - self.tokens) / self.effective_refill_rate
+        # 超过桶容量的请求最多等到桶满
+        cost = min(cost, self.tpm_capacity)
+        if self.tpm_tokens < cost:
+            ready_at = max(
+                ready_at, self.last_refill +
+                (cost - self.tpm_tokens) / self.tpm_refill_rate)
+        if self.org_bucket is not None:
+            ready_at = max(ready_at, self.org_bucket.next_available_at(cost))
+        return ready_at
+
+    def update_limits(self, headers):
+        self.refill_tokens()
+        apply_rate_limit_headers(self, headers)
+        if self.org_bucket is not None:
+            # 限额头反映的其实是整个组织的额度
+            apply_rate_limit_headers(self.org_bucket, headers)
 
-    def can_be_used(self):
+    def is_saturated(self):
+        return self.in_flight >= int(self.max_in_flight)
+
+    def on_success(self):
+        self.refill_tokens()
+        self.max_in_flight = min(self.max_in_flight_ceiling,
+                                 self.max_in_flight + 1 / self.max_in_flight)
+        self.rate_factor = min(self.max_rate_factor,
+                               self.rate_factor + self.aimd_rate_step)
+
+    def hold_off(self, seconds):
+        # 把令牌数压到 seconds 秒之后才会回到 1
         self.refill_tokens()
-        if self.tokens >= 1:
+        self.tokens = min(self.tokens,
+                          1 - seconds * self.effective_refill_rate)
+        if self.org_bucket is not None:
+            self.org_bucket.hold_off(seconds)
+
+    def on_rate_limited(self, retry_after=None):
+        if retry_after:
+            self.hold_off(retry_after)
+        self.refill_tokens()
+        self.max_in_flight = max(self.min_in_flight,
+                                 self.max_in_flight * self.aimd_backoff)
+        self.rate_factor = max(self.min_refill_rate / self.refill_rate,
+                               self.rate_factor * self.aimd_backoff)
+        logger.info(
+            f'managed_session:{self.id} 触发限流，并发上限降到{self.max_in_flight:.2f}，补充速度降到{self.effective_refill_rate:.4f}/s'
+        )
+
+    def can_be_used(self, cost=0):
+        self.refill_tokens()
+        org_has_room = self.org_bucket is None or self.org_bucket.has_room(
+            cost)
+        cost = min(cost, self.tpm_capacity)
+        if self.tokens >= 1 and self.tpm_tokens >= cost and org_has_room:
             self.tokens -= 1
+            self.tpm_tokens -= cost
+            if self.org_bucket is not None:
+                self.org_bucket.consume(cost)
             logger.debug(
                 f'managed_session:{self.id} 被调用 tokens to >> {self.tokens:.2f}'
             )
@@ -80,22 +634,46 @@ class ManagedSession:
             )
             return False
 
+    def take_token(self, cost=0):
+        if self.can_be_used(cost):
+            logger.debug(f'调用session成功，session_id:{self.id}')
+            self.last_used = time.time()
+            return True
+        return False
+
+    def give_back_token(self, cost=0):
+        # 拿到令牌却没有发出请求时，把令牌退回桶里
+        self.tokens = min(self.bucket_capacity, self.tokens + 1)
+        self.tpm_tokens = min(self.tpm_capacity, self.tpm_tokens + cost)
+        if self.org_bucket is not None:
+            self.org_bucket.give_back(cost)
+
+    def refund_tpm(self, amount):
+        # 预留的 token 比实际用掉的多时，把差额退回 TPM 桶；
+        # amount 为负数时补扣超出预留的部分，桶可以扣成负数，补充回来之前不会再分配
+        self.tpm_tokens = min(self.tpm_capacity, self.tpm_tokens + amount)
+        if self.org_bucket is not None:
+            self.org_bucket.refund_tpm(amount)
+
+    def get_session(self):
+        if self.pool is not None:
+            return self.pool.get_session()
+        if self._session is None or self._session.closed:
+            self._session = self.create_session_from_config()
+        return self._session
+
     @property
-    async def session(self):
-        if self.can_be_used():
-            logger.debug(f'调用session成功，并返回，session_id:{self.id}')
-            now = time.time()
-            self.last_used = now
-            if self._session is None or self._session.closed:
-                self._session = self.create_session_from_config()
-            return self._session
-        else:
-            return None
+    def headers(self):
+        # 共享连接池时 session 上没有 key 的请求头，需要每次请求带上
+        return self.config.get('headers')
 
     def create_session_from_config(self):
         # 在这里解析 config 字典，并提取相关配置
         # 示例: 提取代理和超时设置
-        timeout = aiohttp.ClientTimeout(connect=self.config.get('timeout', 30))
+        timeout = aiohttp.ClientTimeout(
+            total=self.config.get('total_timeout', 600),
+            connect=self.config.get('timeout', 30),
+            sock_read=self.config.get('read_timeout', 120))
         headers = self.config.get('headers')
 
         # 创建并返回 aiohttp.ClientSession 实例
@@ -103,21 +681,40 @@ class ManagedSession:
         return session
 
     async def close(self):
-        if self._session is not None and not self._session.closed:
+        # 使用共享连接池时没有自己的 session，什么都不用做；关闭后置为 None，可以重复关闭
+        if self._session is None:
+            return
+        if not self._session.closed:
             logger.info(f'session #{self.id} 正在关闭')
             await self._session.close()
-            del self._session
         else:
-            del self._session
-            logger.info(f'session #{self.id} 已经关闭或不存在，无需关闭')
+            logger.info(f'session #{self.id} 已经关闭，无需关闭')
+        self._session = None
 
 
 @dataclass
 class SessionManager:
     session_configs: list
-    waiting_sessions: list = field(default_factory=list)
+    waiting_sessions: IterCycle = field(init=False)
     used_sessions: IterCycle = field(init=False)
     session_timeout: int = 300  # 会话超时时间（秒）
+    pool: ConnectionPool = field(default_factory=ConnectionPool)
+    scheduler: SessionScheduler = field(default_factory=SessionScheduler,
+                                        init=False)
+    org_buckets: dict = field(default_factory=dict, init=False)
+    tenant_weights: dict = field(default_factory=dict)  # 租户 -> 权重，没有列出的按 1 计
+    drr_quantum: int = 2048  # 每一轮按权重补给租户的 token 额度
+    # 等待 key 的请求：priority -> {租户: TenantQueue}。优先级之间严格有序，
+    # 同一优先级内各租户按权重做 deficit round robin，租户内部按截止时间（EDF）排序
+    _lanes: dict = field(default_factory=dict, init=False)
+    _waiter_seq: count = field(default_factory=count, init=False)
+    # 每个优先级排队的请求数和预留的 token 数，以及所有 key 的补充速度之和，
+    # 随入队、出队和速度调整增量维护，estimate_wait 不用遍历等待队列和所有 key
+    _queued: dict = field(default_factory=dict, init=False)
+    _queued_tokens: dict = field(default_factory=dict, init=False)
+    _request_rate: float = field(default=0, init=False)
+    _tpm_rate: float = field(default=0, init=False)
+    _wakeup_handle: asyncio.TimerHandle = field(default=None, init=False)
 
     def __post_init__(self):
         if len(self.session_configs) == 0:
@@ -126,54 +723,262 @@ class SessionManager:
             )
             raise ValueError('Session configs must not be empty.')
         random.shuffle(self.session_configs)
-        self.waiting_sessions = [
-            ManagedSession(config) for config in self.session_configs
+        managed_sessions = []
+        for config in self.session_configs:
+            org_id = config.get('org_id')
+            org_bucket = None
+            if org_id is not None:
+                org_bucket = self.org_buckets.setdefault(
+                    org_id, OrgBucket(org_id))
+            managed_sessions.append(
+                ManagedSession(config, org_bucket=org_bucket,
+                               pool=self.pool))
+        for managed_session in managed_sessions:
+            self.scheduler.push(managed_session,
+                                managed_session.next_available_at())
+        self.used_sessions = IterCycle([managed_sessions.pop()])
+        self.waiting_sessions = IterCycle(managed_sessions)
+        self.recompute_rates()
+
+    def recompute_rates(self):
+        """重新计算所有 key 的补充速度之和，直接改了 key 的速度参数后需要调用。"""
+        sessions = [
+            *self.used_sessions.items.values(),
+            *self.waiting_sessions.items.values()
         ]
-        self.used_sessions = IterCycle([self.waiting_sessions.pop()])
+        self._request_rate = sum(ms.effective_refill_rate for ms in sessions)
+        self._tpm_rate = sum(ms.tpm_refill_rate for ms in sessions)
 
-    async def get_next_session(self):
-        # 首先检查可用会话列表
-        for _ in range(self.used_sessions.count_items()):
-            logger.debug('在used_sessions表中寻找可用session')
-            managed_session = next(self.used_sessions)
-            session = await managed_session.session
-            if session is not None:
-                logger.debug(
-                    f'在used_sessions表中找到可用session:{managed_session.id}')
-                return session
-
-        logger.info('used_sessions表中无可用会话，从waiting_sessions中寻找')
-        # 然后检查等待列表
-        for managed_session in self.waiting_sessions:
-            logger.debug('寻找waiting_sessions中可用的session')
-            session = await managed_session.session
-            if session is not None:
+    def _rates_changed(self, managed_session, request_rate, tpm_rate):
+        # request_rate / tpm_rate 是这个 key 调整之前的速度
+        self._request_rate += managed_session.effective_refill_rate - request_rate
+        self._tpm_rate += managed_session.tpm_refill_rate - tpm_rate
+
+    def _pick_session(self, cost=0, exclude=None):
+        # 从堆顶取最早有令牌的 key，不再逐个遍历 used_sessions 和 waiting_sessions
+        now = time.time()
+        while True:
+            managed_session = self.scheduler.pop_ready(now)
+            if managed_session is None:
+                logger.warning(
+                    'All keys are in use, please wait a moment before making another call.'
+                )
+                if exclude is not None:
+                    self._reschedule(exclude, wakeup=False)
+                return
+            if managed_session is exclude:
+                # 跳过指定的 key，找到结果后再按它自己的可用时间放回堆里
+                continue
+            taken = managed_session.take_token(cost)
+            if not taken:
+                # TPM 不够这次请求（或浮点误差导致的提前弹出），按本次的 cost 放回堆里继续找
+                self.scheduler.push(managed_session,
+                                    managed_session.next_available_at(cost))
+                continue
+            managed_session.in_flight += 1
+            self._reschedule(managed_session, wakeup=False)
+            if managed_session in self.waiting_sessions:
                 # 将可用的会话移到可用列表
-                logger.debug(f'找到可用的session，#{managed_session.id}')
-                logger.debug(f'waiting_sessions:#{len(self.waiting_sessions)}')
-                logger.debug(
-                    f'used_sessions:#{self.used_sessions.count_items()}')
-                logger.debug(f'session的config为{managed_session.config}')
-                logger.debug(f'session的请求头为{session.headers}')
+                logger.debug(f'从waiting_sessions中启用session，#{managed_session.id}')
                 self.waiting_sessions.remove(managed_session)
                 self.used_sessions.add(managed_session)
-                return session
+            if exclude is not None:
+                self._reschedule(exclude, wakeup=False)
+            return managed_session
 
-        # 所有会话都不可用，返回None
-        logger.warning(
-            'All keys are in use, please wait a moment before making another call.'
-        )
-        return
+    def try_acquire(self, cost=0, exclude=None):
+        """不等待地取一个有令牌的 key，取不到时返回 None，exclude 指定的 key 不会被选中。
+
+        用于对冲请求：只使用空闲的额度，不和等待队列里的请求抢 key。
+        """
+        if self._lanes:
+            return None
+        return self._pick_session(cost, exclude)
+
+    def estimate_wait(self, priority=PRIORITY_INTERACTIVE):
+        """估算一个新请求排队等 key 的时间（秒）。
+
+        只看排在它前面（优先级不低于 priority）的请求，按请求数和预留的 token 数
+        分别除以所有 key 的补充速度之和，取较大的一个。
+        """
+        ahead, tokens = 0, 0
+        for lane_priority, queued in self._queued.items():
+            if lane_priority <= priority:
+                ahead += queued
+                tokens += self._queued_tokens[lane_priority]
+        if not ahead:
+            return 0
+        return max(ahead / self._request_rate, tokens / self._tpm_rate)
+
+    def queue_depth(self):
+        """正在等待 key 的请求数。"""
+        return sum(self._queued.values())
+
+    async def acquire(self,
+                      cost=0,
+                      priority=PRIORITY_INTERACTIVE,
+                      deadline=None,
+                      tenant=DEFAULT_TENANT):
+        """等待直到某个 key 有令牌可用，返回已扣除令牌的 ManagedSession。
+
+        cost 是本次请求预留的 token 数，请求数桶和 TPM 桶都够用才会分配。
+        没有可用 key 时协程挂在等待队列里，按令牌桶的补充速度计算出最早可用的时间再唤醒，
+        不会阻塞事件循环。
+        等待队列先按 priority 排序，同一优先级内截止时间早的先分配，没有截止时间的排在最后，
+        所以只要有在线请求在等，批量请求就拿不到 key。
+        同一优先级内按 tenant_weights 在租户之间分配额度，一个租户排了再多请求，
+        其他租户也能按权重分到 key。
+        """
+        if not any(lane <= priority for lane in self._lanes):
+            managed_session = self._pick_session(cost)
+            if managed_session is not None:
+                return managed_session
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._enqueue(waiter, cost, priority, deadline, tenant)
+        self._schedule_wakeup()
+        try:
+            return await waiter
+        except asyncio.CancelledError:
+            # 已经分到了 key 但调用方被取消，把令牌还回去
+            if waiter.done() and not waiter.cancelled():
+                self.give_back(waiter.result(), cost)
+            else:
+                # 没分到 key 就被取消，等待项留在堆里之后再清理，这里先从计数里去掉
+                self._dequeued(priority, cost)
+            raise
+
+    def _enqueue(self, waiter, cost, priority, deadline, tenant):
+        lane = self._lanes.setdefault(priority, OrderedDict())
+        queue = lane.get(tenant)
+        if queue is None:
+            weight = self.tenant_weights.get(tenant, 1)
+            if weight <= 0:
+                raise ValueError(f'Weight of tenant {tenant} must be positive.')
+            queue = lane[tenant] = TenantQueue(tenant, weight)
+        heapq.heappush(queue.waiters,
+                       (deadline if deadline is not None else float('inf'),
+                        next(self._waiter_seq), waiter, cost))
+        self._queued[priority] = self._queued.get(priority, 0) + 1
+        self._queued_tokens[priority] = self._queued_tokens.get(priority,
+                                                                0) + cost
+
+    def _dequeued(self, priority, cost):
+        self._queued[priority] -= 1
+        self._queued_tokens[priority] -= cost
+        if not self._queued[priority]:
+            del self._queued[priority]
+            del self._queued_tokens[priority]
+
+    def _next_waiter(self):
+        """找出下一个应该分到 key 的请求，返回 (优先级, TenantQueue, 等待项)，没有时返回 (None, None, None)。"""
+        for priority in sorted(self._lanes):
+            lane = self._lanes[priority]
+            while lane:
+                queue = next(iter(lane.values()))
+                head = queue.head()
+                if head is None:
+                    # 队列空了的租户退出轮转，剩余额度作废
+                    del lane[queue.name]
+                    continue
+                if queue.deficit >= head[3]:
+                    return priority, queue, head
+                # 额度不够发这个请求，补一轮额度后轮到下一个租户
+                queue.deficit += self.drr_quantum * queue.weight
+                lane.move_to_end(queue.name)
+            del self._lanes[priority]
+        return None, None, None
+
+    def _schedule_wakeup(self):
+        if self._wakeup_handle is not None:
+            self._wakeup_handle.cancel()
+            self._wakeup_handle = None
+        if not self._lanes:
+            return
+        ready_at = self.scheduler.peek_ready_at()
+        if ready_at is None:
+            # 所有 key 都到了并发上限，等请求结束调用 release 时再唤醒
+            return
+        delay = max(0, ready_at - time.time())
+        # 每次归还 key 都会走到这里，没开 DEBUG 时不拼接日志
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'等待队列中有{self.queue_depth()}个请求，{delay:.2f}秒后唤醒')
+        self._wakeup_handle = asyncio.get_running_loop().call_later(
+            delay, self._wake_waiters)
+
+    def _wake_waiters(self):
+        self._wakeup_handle = None
+        while True:
+            priority, queue, head = self._next_waiter()
+            if head is None:
+                break
+            _, _, waiter, cost = head
+            managed_session = self._pick_session(cost)
+            if managed_session is None:
+                break
+            heapq.heappop(queue.waiters)
+            self._dequeued(priority, cost)
+            queue.deficit -= cost
+            waiter.set_result(managed_session)
+        self._schedule_wakeup()
+
+    def give_back(self, managed_session, cost=0):
+        managed_session.in_flight -= 1
+        managed_session.give_back_token(cost)
+        self._reschedule(managed_session)
+
+    def release(self, managed_session, reserved, used):
+        """请求结束后释放并发名额，并按 usage 里的实际用量多退少补预留的 TPM。"""
+        managed_session.in_flight -= 1
+        if reserved != used:
+            managed_session.refund_tpm(reserved - used)
+        self._reschedule(managed_session)
+
+    def on_success(self, managed_session):
+        rates = managed_session.effective_refill_rate, managed_session.tpm_refill_rate
+        managed_session.on_success()
+        self._rates_changed(managed_session, *rates)
+
+    def on_rate_limited(self, managed_session, retry_after=None):
+        rates = managed_session.effective_refill_rate, managed_session.tpm_refill_rate
+        managed_session.on_rate_limited(retry_after)
+        self._rates_changed(managed_session, *rates)
+        self._reschedule(managed_session)
+
+    def suspend(self, managed_session, seconds):
+        logger.warning(f'managed_session:{managed_session.id} 暂停使用{seconds}秒')
+        managed_session.hold_off(seconds)
+        self._reschedule(managed_session)
+
+    def update_limits(self, managed_session, headers):
+        rates = managed_session.effective_refill_rate, managed_session.tpm_refill_rate
+        managed_session.update_limits(headers)
+        self._rates_changed(managed_session, *rates)
+        self._reschedule(managed_session)
+
+    def _reschedule(self, managed_session, wakeup=True):
+        # 到了并发上限的 key 暂时移出堆，release 之后再放回来
+        if managed_session.is_saturated():
+            self.scheduler.remove(managed_session)
+        else:
+            self.scheduler.push(managed_session,
+                                managed_session.next_available_at())
+        if wakeup:
+            self._schedule_wakeup()
 
     async def close_inactive_sessions(self):
         """关闭长时间不用的会话。"""
         current_time = time.time()
         for _ in range(self.used_sessions.count_items()):
             managed_session = next(self.used_sessions)
-            if current_time - managed_session.last_used > self.session_timeout:
+            if (current_time - managed_session.last_used > self.session_timeout
+                    and managed_session.in_flight == 0):
                 await managed_session.close()
                 self.used_sessions.remove(managed_session)
-                self.waiting_sessions.append(managed_session)
+                self.waiting_sessions.add(managed_session)
+        # 所有 key 都闲置时连共享连接池一起关掉，下次请求时会重新创建
+        if self.pool is not None and self.used_sessions.count_items() == 0:
+            await self.pool.close()
 
     async def close_all_sessions(self):
         # 关闭所有会话
@@ -181,7 +986,9 @@ class SessionManager:
             managed_session = next(self.used_sessions)
             await managed_session.close()
             self.used_sessions.remove(managed_session)
-            self.waiting_sessions.append(managed_session)
+            self.waiting_sessions.add(managed_session)
+        if self.pool is not None:
+            await self.pool.close()
 
 
 @dataclass
@@ -196,6 +1003,275 @@ class StatusTracker:
     num_api_errors: int = 0  # excluding rate limit errors, counted above
     num_other_errors: int = 0
     time_of_last_rate_limit_error: int = 0  # used to cool off after hitting rate limits
+    num_retries_over_budget: int = 0  # retries refused by the global retry budget
+    num_hedged_requests: int = 0  # duplicate attempts fired on a second key
+    num_hedge_wins: int = 0  # hedges that answered before the original attempt
+    num_deadline_exceeded: int = 0  # requests abandoned at their deadline
+    num_rejected_overloaded: int = 0  # requests refused by admission control
+    num_cache_hits: int = 0  # requests answered from the response cache
+    num_coalesced: int = 0  # requests that shared an identical in-flight call
+    num_samples_collapsed: int = 0  # duplicate prompts folded into another call's n
+    tenants: dict = field(default_factory=dict)  # tenant name -> TenantStats
+
+    def tenant(self, name):
+        if name not in self.tenants:
+            self.tenants[name] = TenantStats()
+        return self.tenants[name]
+
+
+@dataclass
+class TenantStats:
+    """Per-tenant counters kept in StatusTracker.tenants."""
+
+    num_tasks_started: int = 0
+    num_tasks_succeeded: int = 0
+    num_tasks_failed: int = 0
+    num_tokens_used: int = 0
+    total_queue_time: float = 0  # seconds spent waiting for a key
+
+
+@dataclass
+class RetryBudget:
+    """全局重试预算：window 秒内的重试次数不超过首次请求数的 ratio 倍，另有 min_retries 次保底。
+
+    上游出问题时，每个请求各自把重试次数用完会让负载成倍增加，超出预算的重试直接放弃。
+    计数按秒分桶，内存只和窗口长度有关。
+    """
+    ratio: float = 0.1
+    window: int = 60
+    min_retries: int = 10
+    _buckets: deque = field(default_factory=deque, init=False)
+    _requests: int = field(default=0, init=False)
+    _retries: int = field(default=0, init=False)
+
+    def _current_bucket(self):
+        now = int(time.time())
+        while self._buckets and self._buckets[0][0] <= now - self.window:
+            _, requests, retries = self._buckets.popleft()
+            self._requests -= requests
+            self._retries -= retries
+        if not self._buckets or self._buckets[-1][0] != now:
+            self._buckets.append([now, 0, 0])
+        return self._buckets[-1]
+
+    def record_request(self):
+        self._current_bucket()[1] += 1
+        self._requests += 1
+
+    def try_spend(self):
+        bucket = self._current_bucket()
+        if self._retries >= self.min_retries + self.ratio * self._requests:
+            return False
+        bucket[2] += 1
+        self._retries += 1
+        return True
+
+
+@dataclass
+class HedgePolicy:
+    """对冲请求：一次尝试超过最近成功延迟的 percentile 分位数还没返回，就换一个 key 再发一份，
+    先返回的结果生效，另一个取消。
+
+    样本不足 min_samples 时不对冲；对冲次数受 budget 限制，默认不超过请求数的 5%，
+    避免上游整体变慢时把负载翻倍。
+    """
+    percentile: float = 0.95
+    min_samples: int = 20
+    sample_size: int = 1000
+    refresh_every: int = 50  # 每记录这么多个样本重新计算一次分位数
+    budget: RetryBudget = field(
+        default_factory=lambda: RetryBudget(ratio=0.05, min_retries=0))
+    _latencies: deque = field(init=False)
+    _delay: float = field(default=None, init=False)
+    _since_refresh: int = field(default=0, init=False)
+
+    def __post_init__(self):
+        self._latencies = deque(maxlen=self.sample_size)
+
+    def record(self, latency):
+        self._latencies.append(latency)
+        self._since_refresh += 1
+
+    def delay(self):
+        """发出对冲前等待的秒数，样本不足时返回 None。"""
+        if len(self._latencies) < self.min_samples:
+            return None
+        if self._delay is None or self._since_refresh >= self.refresh_every:
+            latencies = sorted(self._latencies)
+            self._delay = latencies[int(self.percentile * (len(latencies) - 1))]
+            self._since_refresh = 0
+        return self._delay
+
+
+@dataclass
+class CoolOffCoordinator:
+    """全局冷却：短时间内集中出现 429 时，暂停所有新请求的发送。
+
+    burst_window 秒内出现 burst_threshold 次 429 视为一次爆发，暂停时间随爆发规模增长，
+    并且不短于服务端给出的 Retry-After。等待中的请求在暂停结束后自动继续。
+    """
+    status_tracker: StatusTracker
+    burst_threshold: int = 3
+    burst_window: float = 10
+    base_cool_off: float = 15
+    max_cool_off: float = 60
+    paused_until: float = 0
+    _recent: deque = field(default_factory=deque, init=False)
+
+    def record_rate_limit(self, retry_after=None):
+        now = time.time()
+        self.status_tracker.time_of_last_rate_limit_error = now
+        self._recent.append(now)
+        while self._recent and now - self._recent[0] > self.burst_window:
+            self._recent.popleft()
+        if len(self._recent) < self.burst_threshold:
+            return
+        cool_off = min(
+            self.max_cool_off,
+            self.base_cool_off * len(self._recent) / self.burst_threshold)
+        cool_off = max(cool_off, retry_after or 0)
+        if now + cool_off > self.paused_until:
+            self.paused_until = now + cool_off
+            logger.warning(
+                f'{self.burst_window}秒内出现{len(self._recent)}次限流，暂停发送{cool_off:.1f}秒'
+            )
+
+    async def wait(self):
+        while (remaining := self.paused_until - time.time()) > 0:
+            await asyncio.sleep(remaining)
+
+
+def request_cache_key(request_json):
+    """请求体的规范化哈希：键排序、去掉多余空白后取 sha256，字段顺序不同的相同请求得到同一个 key。"""
+    canonical = json.dumps(request_json,
+                           sort_keys=True,
+                           separators=(',', ':'),
+                           ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+def is_deterministic(request_json):
+    # 不传 temperature 时接口按 1 处理，结果每次都不一样
+    return request_json.get('temperature') == 0
+
+
+@dataclass
+class ResponseCache:
+    """按请求体内容缓存成功的响应：内存里一份 LRU，磁盘上一份 SQLite。
+
+    默认只缓存 temperature 为 0 的请求，cache_all=True 时缓存所有请求。
+    超过 ttl 秒的条目视为过期；磁盘上的响应总大小超过 max_disk_bytes 时，
+    按最近访问时间淘汰最久没用的条目。
+    """
+    path: str = 'response_cache.sqlite3'
+    memory_entries: int = 1024
+    max_disk_bytes: int = 256 * 1024 * 1024
+    ttl: float = 7 * 24 * 3600
+    cache_all: bool = False
+    _memory: OrderedDict = field(default_factory=OrderedDict, init=False)
+    _db: sqlite3.Connection = field(default=None, init=False)
+    _disk_bytes: int = field(default=0, init=False)
+    # SQLite 的读写放在线程里做，同一个连接要串行使用
+    _lock: threading.Lock = field(default_factory=threading.Lock, init=False)
+
+    def cacheable(self, request_json):
+        return self.cache_all or is_deterministic(request_json)
+
+    async def get(self, request_json):
+        key = request_cache_key(request_json)
+        now = time.time()
+        entry = self._memory.get(key)
+        if entry is not None:
+            expires_at, response = entry
+            if expires_at > now:
+                self._memory.move_to_end(key)
+                return response
+            del self._memory[key]
+        row = await asyncio.to_thread(self._load, key, now)
+        if row is None:
+            return None
+        created, response = row
+        self._remember(key, created + self.ttl, response)
+        return response
+
+    async def put(self, request_json, response):
+        key = request_cache_key(request_json)
+        now = time.time()
+        self._remember(key, now + self.ttl, response)
+        await asyncio.to_thread(self._store, key, json.dumps(response), now)
+
+    def _remember(self, key, expires_at, response):
+        self._memory[key] = (expires_at, response)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.memory_entries:
+            self._memory.popitem(last=False)
+
+    def _connect(self):
+        if self._db is None:
+            self._db = sqlite3.connect(self.path, check_same_thread=False)
+            self._db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                             'key TEXT PRIMARY KEY, response TEXT, '
+                             'size INTEGER, created REAL, accessed REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed '
+                             'ON responses (accessed)')
+            self._disk_bytes = self._db.execute(
+                'SELECT COALESCE(SUM(size), 0) FROM responses').fetchone()[0]
+        return self._db
+
+    def _load(self, key, now):
+        with self._lock:
+            db = self._connect()
+            row = db.execute(
+                'SELECT created, response FROM responses WHERE key = ?',
+                (key, )).fetchone()
+            if row is None:
+                return None
+            if row[0] + self.ttl <= now:
+                self._delete(db, 'key = ?', (key, ))
+                db.commit()
+                return None
+            db.execute('UPDATE responses SET accessed = ? WHERE key = ?',
+                       (now, key))
+            db.commit()
+            return row[0], json.loads(row[1])
+
+    def _store(self, key, response, now):
+        size = len(response.encode('utf-8'))
+        with self._lock:
+            db = self._connect()
+            self._delete(db, 'key = ?', (key, ))
+            db.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?)',
+                       (key, response, size, now, now))
+            self._disk_bytes += size
+            if self._disk_bytes > self.max_disk_bytes:
+                self._evict(db, now)
+            db.commit()
+
+    def _evict(self, db, now):
+        # 先删过期的，还超出大小就从最久没访问的开始删
+        self._delete(db, 'created <= ?', (now - self.ttl, ))
+        while self._disk_bytes > self.max_disk_bytes:
+            rows = db.execute(
+                'SELECT key FROM responses ORDER BY accessed LIMIT 100'
+            ).fetchall()
+            if not rows:
+                break
+            for (key, ) in rows:
+                self._delete(db, 'key = ?', (key, ))
+                if self._disk_bytes <= self.max_disk_bytes:
+                    break
+
+    def _delete(self, db, where, args):
+        freed = db.execute(f'SELECT COALESCE(SUM(size), 0) FROM responses '
+                           f'WHERE {where}', args).fetchone()[0]
+        db.execute(f'DELETE FROM responses WHERE {where}', args)
+        self._disk_bytes -= freed
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
 
 
 @dataclass
@@ -206,118 +1282,1145 @@ class APIRequest:
     result: list = field(default_factory=list)
     id: uuid.UUID = field(default_factory=uuid.uuid4)
     attempts_left: int = 5
-    delay: int = 3
+    cool_off: CoolOffCoordinator = None
+    proxy_pool: ProxyPool = None
+    retry_budget: RetryBudget = None
+    hedging: HedgePolicy = None  # 不为 None 时对慢请求发出对冲
+    deadline: float = None  # 截止时间（time.time() 时间戳），None 表示不限
+    priority: int = PRIORITY_INTERACTIVE
+    tenant: str = DEFAULT_TENANT
+    cache: ResponseCache = None
+    token_cost: int = field(init=False)
+    response: dict = field(default=None, init=False)
+    latency: float = field(default=None, init=False)  # 从第一次尝试到结束的秒数
+    key_id: uuid.UUID = field(default=None, init=False)  # 最后一次使用的 key
+    metadata: object = None  # 调用方附带的信息，原样保留，不会发给接口
+    error_kind: str = field(default=None, init=False)  # 最近一次失败的错误分类
+    retry_after: float = field(default=None, init=False)
+    over_budget: bool = field(default=False, init=False)  # 因为重试预算用完而放弃
+    # 为 True 时，超出重试预算不算失败，由调用方推迟到之后再发送
+    may_defer: bool = field(default=False, init=False)
+    cached: bool = field(default=False, init=False)  # 响应来自缓存，没有发出请求
+    coalesced: bool = field(default=False, init=False)  # 和同时发出的相同请求共用了一次调用
+    expired: bool = field(default=False, init=False)  # 因为超过截止时间而放弃
+    retry_delay: float = field(default=None, init=False)  # 下一次重试前需要等待的秒数
+    started: float = field(default=None, init=False)
+    _backoff: float = field(default=None, init=False)
+
+    def __post_init__(self):
+        self.token_cost = estimate_token_cost(self.request_json)
 
     async def call_llm_single(
         self,
-        session,
+        managed_session,
     ):
-        url = "https://api.openai.com/v1/chat/completions"
-        proxy = "http://127.0.0.1:7890"
+        url = API_URL
         """Calls the OpenAI API and saves results."""
         logging.info(f"Starting request #{self.id}")
         logging.info(f"请求体为：{self.request_json}")
+        if self.proxy_pool is None:
+            return await self._call_llm_single(managed_session, url, PROXY)
+
+        # key 的 config 里指定了 proxy 时优先用它，不健康或满了再换别的
+        try:
+            proxy_state = await self._before_deadline(
+                self.proxy_pool.acquire(managed_session.config.get('proxy')))
+        except asyncio.TimeoutError:
+            raise DeadlineExceeded(f'Request {self.id} 等待代理时超过截止时间')
+        started = time.time()
+        transport_ok = None  # 被取消时只释放名额，不计入代理的健康统计
+        try:
+            outcome = await self._call_llm_single(managed_session, url,
+                                                  proxy_state.url)
+            # 只有连接层面的错误才算代理的问题，接口返回的错误不算
+            transport_ok = outcome[1] not in (TIMEOUT, CONNECTION)
+            return outcome
+        finally:
+            self.proxy_pool.release(proxy_state, time.time() - started,
+                                    transport_ok)
+
+    async def _call_llm_single(self, managed_session, url, proxy):
+        """发送一次请求，返回 (响应, 错误类型, Retry-After)。
+
+        对冲时同一个请求会有几次调用同时进行，所以错误类型和 Retry-After 随结果返回，
+        不写在请求上，由 try_once 取最终采用的那一次。
+        """
         error = None
+        error_kind = None
+        retry_after = None
+        session = managed_session.get_session()
+        kwargs = {}
+        if self.deadline is not None:
+            # aiohttp 把 total=0 当作不限时，所以到期了就不再发出请求
+            if self.remaining() <= 0:
+                raise DeadlineExceeded(f'Request {self.id} 发送前已超过截止时间')
+            kwargs['timeout'] = self._attempt_timeout(session.timeout)
         try:
             async with session.post(
                     url=url,
                     proxy=proxy,
+                    headers=managed_session.headers,
                     json=self.request_json,
+                    **kwargs,
             ) as response:
-                response = await response.json()
-            if response is None:
-                logging.warning(f"Request {self.id} 返回了None")
-                raise Exception("响应为空")
-            if "error" in response:
-                error = response
-                response = None
-                if "Rate limit" in response["error"].get("message", ""):
-                    logging.warning(
-                        f"Request {self.id} failed with Rate limit error {response['error']}"
-                    )
-                    self.status_tracker.num_rate_limit_errors += 1
+                # 限流的响应里也有这些头，同样用来校准
+                self.session_manager.update_limits(managed_session,
+                                                   response.headers)
+                status = response.status
+                response_retry_after = parse_retry_after(response.headers)
+                try:
+                    # 代理或网关返回的错误页不是 JSON，按状态码分类
+                    response = await response.json(content_type=None)
+                except ValueError:
+                    response = None
+            # 空的响应体（例如 {}）也不算成功，没有错误信息时按 OTHER 重试
+            if status >= 400 or not isinstance(
+                    response, dict) or not response or "error" in response:
+                if isinstance(response, dict) and response:
+                    error = response
                 else:
-                    logging.warning(
-                        f"Request {self.id} failed with error {response['error']}"
-                    )
-                    self.status_tracker.num_api_errors += 1
+                    error = Exception(f"HTTP {status}，响应为空或不是有效的 JSON")
+                response = None
+                error_kind = classify_response_error(status, error)
+                retry_after = response_retry_after
+                logging.warning(
+                    f"Request {self.id} failed with {error_kind} error {error}"
+                )
 
         except (
                 Exception
         ) as e:  # catching naked exceptions is bad practice, but in this case we'll log & save them
             logging.warning(f"Request {self.id} failed with Exception {e}")
-            self.status_tracker.num_other_errors += 1
+            error_kind = classify_exception(e)
             error = e
 
-        if error:
-            self.result.append(error)
+        if error is not None:
+            self._record_error(managed_session, error, error_kind, retry_after)
+            return None, error_kind, retry_after
+        self.session_manager.on_success(managed_session)
+        return response, None, None
+
+    def _record_error(self, managed_session, error, error_kind, retry_after):
+        self.result.append(error)
+        if error_kind == RATE_LIMIT:
+            self.status_tracker.num_rate_limit_errors += 1
+            self.session_manager.on_rate_limited(managed_session, retry_after)
+            if self.cool_off is not None:
+                self.cool_off.record_rate_limit(retry_after)
+        elif error_kind == QUOTA:
+            self.status_tracker.num_api_errors += 1
+            self.session_manager.suspend(managed_session, QUOTA_SUSPEND_SECONDS)
+        elif error_kind == KEY_ERROR:
+            self.status_tracker.num_api_errors += 1
+            logging.error(f"key #{managed_session.id} 无效或已停用：{error}")
+            self.session_manager.suspend(managed_session,
+                                         KEY_ERROR_SUSPEND_SECONDS)
+        elif error_kind in (SERVER, FATAL):
+            self.status_tracker.num_api_errors += 1
         else:
-            self.status_tracker.num_tasks_in_progress -= 1
-            self.status_tracker.num_tasks_succeeded += 1
-            return response
+            self.status_tracker.num_other_errors += 1
 
-    async def call_llm(self):
-        while self.attempts_left > 0:
-            logger.debug(f'发起请求#{self.id}，还有{self.attempts_left - 1}次重试机会')
-            session_available = True
+    def remaining(self):
+        """距离截止时间还剩的秒数，没有截止时间时返回 None。"""
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
 
-            session = await self.session_manager.get_next_session()
-            logger.debug(session)
-            logger.debug(
-                f"session的请求头是：{getattr(session, 'headers', '没有headers')}")
-            logger.debug(getattr(session, 'post', '没有post！'))
-            if getattr(session, 'post', '没有post！') == '没有post！':
-                logger.debug(f'session的dir：f{dir(session)}')
+    def _attempt_timeout(self, timeout):
+        # 单次请求的总时长不超过剩余时间（调用前已确认大于 0），其余超时设置沿用 session 的
+        total = self.remaining()
+        if timeout.total is not None:
+            total = min(total, timeout.total)
+        return aiohttp.ClientTimeout(total=total,
+                                     connect=timeout.connect,
+                                     sock_read=timeout.sock_read,
+                                     sock_connect=timeout.sock_connect)
 
-            if session is not None:
-                response = await self.call_llm_single(session, )
+    async def _before_deadline(self, aw):
+        if self.deadline is None:
+            return await aw
+        return await asyncio.wait_for(aw, max(0, self.remaining()))
+
+    def next_delay(self, policy):
+        """Decorrelated jitter：在 [base, 上次等待 * 3] 之间随机，不超过 max_delay，且不短于 Retry-After。"""
+        if self._backoff is None:
+            self._backoff = policy.base_delay
+        self._backoff = min(
+            policy.max_delay,
+            random.uniform(policy.base_delay,
+                           max(policy.base_delay, self._backoff * 3)))
+        return max(self._backoff, self.retry_after or 0)
+
+    async def try_once(self):
+        """发送一次请求。
+
+        请求结束（成功，或失败且不再重试）时返回 True；需要重试时返回 False，
+        并在 retry_delay 中给出重试前应等待的秒数，由调用方决定在哪里等待。
+        """
+        if self.started is None:
+            self.started = time.time()
+            if self._use_cache():
+                try:
+                    response = await self.cache.get(self.request_json)
+                except Exception as e:
+                    # 缓存不可用（例如 SQLite 文件被锁或损坏）时当作没有命中
+                    logger.warning(f'读取响应缓存失败：{e}')
+                    response = None
+                if response is not None:
+                    logger.debug(f'请求#{self.id}命中缓存')
+                    self.cached = True
+                    self.status_tracker.num_cache_hits += 1
+                    return self._succeed(response)
+            if self.retry_budget is not None:
+                self.retry_budget.record_request()
+        logger.debug(f'发起请求#{self.id}，还有{self.attempts_left - 1}次重试机会')
+        if self.deadline is not None and self.remaining() <= 0:
+            return self._expire()
+
+        try:
+            if self.cool_off is not None:
+                if (self.deadline is not None
+                        and self.cool_off.paused_until >= self.deadline):
+                    # 冷却结束时已经过了截止时间，不必再等
+                    return self._expire()
+                await self._before_deadline(self.cool_off.wait())
+            # 超时取消时 acquire 会把已经分到的令牌退回去
+            queued = time.time()
+            try:
+                managed_session = await self._before_deadline(
+                    self.session_manager.acquire(self.token_cost,
+                                                 self.priority, self.deadline,
+                                                 self.tenant))
+            finally:
+                self.status_tracker.tenant(
+                    self.tenant).total_queue_time += time.time() - queued
+        except asyncio.TimeoutError:
+            return self._expire()
+        try:
+            if self.hedging is None:
+                outcome = await self._attempt(managed_session)
             else:
-                time.sleep(self.delay)
-                session_available = False
-                continue
+                outcome = await self._hedged_attempt(managed_session)
+        except DeadlineExceeded:
+            return self._expire()
+        response, self.error_kind, self.retry_after = outcome
+        if response is not None:
+            if self._use_cache():
+                try:
+                    await self.cache.put(self.request_json, response)
+                except Exception as e:
+                    logger.warning(f'写入响应缓存失败：{e}')
+            self.status_tracker.tenant(
+                self.tenant).num_tokens_used += response.get('usage', {}).get(
+                    'total_tokens', 0)
+            return self._succeed(response)
 
-            if response:
-                return response
+        policy = RETRY_POLICIES[self.error_kind]
+        if not policy.retry:
+            logging.warning(f"Request {self.id} 遇到{self.error_kind}错误，不再重试")
+            return self._fail()
+
+        self.attempts_left -= 1
+        if self.attempts_left <= 0:
+            return self._fail()
+        if self.retry_budget is not None and not self.retry_budget.try_spend():
+            logging.warning(f"Request {self.id} 全局重试预算已用完，不再重试")
+            self.status_tracker.num_retries_over_budget += 1
+            self.over_budget = True
+            if self.may_defer:
+                self.retry_delay = None
+                return False
+            return self._fail()
+        self.retry_delay = self.next_delay(policy)
+        if self.deadline is not None and self.retry_delay >= self.remaining():
+            # 等到可以重试时已经过了截止时间，现在就放弃，不再占用令牌
+            return self._expire()
+        return False
 
-            if session_available:
-                self.attempts_left -= 1
+    def _use_cache(self):
+        return self.cache is not None and self.cache.cacheable(
+            self.request_json)
+
+    def _succeed(self, response):
+        self.response = response
+        self.latency = time.time() - self.started
+        self.status_tracker.num_tasks_in_progress -= 1
+        self.status_tracker.num_tasks_succeeded += 1
+        self.status_tracker.tenant(self.tenant).num_tasks_succeeded += 1
+        return True
 
-            time.sleep(self.delay)
+    def _expire(self):
+        logging.warning(f"Request {self.id} 超过截止时间，放弃")
+        self.result.append(DeadlineExceeded(f'Request {self.id} 超过截止时间'))
+        self.error_kind = TIMEOUT
+        self.expired = True
+        self.status_tracker.num_deadline_exceeded += 1
+        return self._fail()
 
+    async def _attempt(self, managed_session):
+        logger.debug(f'使用session #{managed_session.id} 发送请求')
+        self.key_id = managed_session.id
+        started = time.time()
+        response = None
+        try:
+            outcome = await self.call_llm_single(managed_session, )
+            response = outcome[0]
+        finally:
+            # 失败或被取消的请求不计入用量，预留的 token 全部退回
+            used_tokens = response.get('usage', {}).get(
+                'total_tokens', 0) if response is not None else 0
+            self.session_manager.release(managed_session, self.token_cost,
+                                         used_tokens)
+        if response is not None:
+            self.key_id = managed_session.id
+            if self.hedging is not None:
+                self.hedging.record(time.time() - started)
+        return outcome
+
+    async def _hedged_attempt(self, managed_session):
+        """先用 managed_session 发送，超过对冲延迟还没返回时换一个空闲的 key 再发一份。"""
+        self.hedging.budget.record_request()
+        primary = asyncio.create_task(self._attempt(managed_session))
+        pending = {primary}
+        try:
+            delay = self.hedging.delay()
+            if delay is not None:
+                done, _ = await asyncio.wait(pending, timeout=delay)
+                if not done:
+                    self._fire_hedge(managed_session, delay, pending)
+            # 有一份成功就用它，都失败时用最后失败的那一份的错误类型
+            outcome = None
+            while pending and (outcome is None or outcome[0] is None):
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    result = task.result()
+                    if outcome is None or outcome[0] is None:
+                        outcome = result
+                        if result[0] is not None and task is not primary:
+                            self.status_tracker.num_hedge_wins += 1
+            return outcome
+        finally:
+            # 取消落后的一份，等它释放 key 和代理后再返回
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+
+    def _fire_hedge(self, managed_session, delay, pending):
+        hedge_session = self.session_manager.try_acquire(
+            self.token_cost, exclude=managed_session)
+        if hedge_session is None:
+            return
+        if not self.hedging.budget.try_spend():
+            self.session_manager.give_back(hedge_session, self.token_cost)
+            return
+        logger.info(
+            f'Request {self.id} 超过{delay:.2f}秒未返回，用session #{hedge_session.id} 发出对冲请求'
+        )
+        self.status_tracker.num_hedged_requests += 1
+        pending.add(asyncio.create_task(self._attempt(hedge_session)))
+
+    def _fail(self):
         logging.error(
             f"Request {self.request_json} failed after all attempts. Saving errors: {self.result}"
         )
+        self.latency = time.time() - self.started
         self.status_tracker.num_tasks_in_progress -= 1
         self.status_tracker.num_tasks_failed += 1
+        self.status_tracker.tenant(self.tenant).num_tasks_failed += 1
+        return True
+
+    async def call_llm(self):
+        while not await self.try_once():
+            await asyncio.sleep(self.retry_delay)
+        return self.response
+
+
+@dataclass
+class SampleGroup:
+    """合并成一次 n=K 调用的 K 个相同请求，members 是原始的 (request_id, 请求体, metadata)。"""
+    members: list
+
+
+def _group_item(members):
+    if len(members) == 1:
+        return members[0]
+    request_json = dict(members[0][1], n=len(members))
+    return None, request_json, SampleGroup(members)
+
+
+async def collapse_samples(source, max_n, window=1000, max_wait=1.0):
+    """把 source 中请求体完全相同的请求合并成一个 n=K 的请求，K 不超过 max_n。
+
+    只在最近读到的 window 个请求里找相同的请求，缓冲满了就先发出最早的一组；
+    一组最多等 max_wait 秒，到时没凑满也会发出，不会一直等后面的输入。
+    已经带 n>1 或者 stream 的请求原样发出。合并后的元素是
+    (None, 请求体, SampleGroup)，结果用 fan_out_samples 拆回原来的请求。
+    """
+    # 在单独的 task 里读 source，这边才能按超时发出等待太久的组
+    items = asyncio.Queue(maxsize=1)
+
+    async def read():
+        error = None
+        try:
+            if hasattr(source, '__aiter__'):
+                async for item in source:
+                    await items.put((False, item))
+            else:
+                for item in source:
+                    await items.put((False, item))
+        except Exception as e:
+            error = e
+        await items.put((True, error))
+
+    reader = asyncio.create_task(read())
+    groups = OrderedDict()  # 请求体哈希 -> (第一个请求到达的时间, members)，最早的在前
+    buffered = 0
+    try:
+        while True:
+            now = time.time()
+            while groups:
+                key, (first_seen, members) = next(iter(groups.items()))
+                if first_seen + max_wait > now:
+                    break
+                del groups[key]
+                buffered -= len(members)
+                yield _group_item(members)
+            timeout = None
+            if groups:
+                timeout = next(iter(groups.values()))[0] + max_wait - now
+            try:
+                finished, item = await asyncio.wait_for(items.get(), timeout)
+            except asyncio.TimeoutError:
+                continue
+            if finished:
+                if item is not None:
+                    raise item
+                break
+            if not isinstance(item, tuple):
+                item = (None, item)
+            request_id, request_json, metadata = (*item, None)[:3]
+            if request_json.get('n', 1) != 1 or request_json.get('stream'):
+                yield item
+                continue
+            key = request_cache_key(request_json)
+            _, members = groups.setdefault(key, (now, []))
+            members.append((request_id, request_json, metadata))
+            buffered += 1
+            if len(members) >= max_n:
+                del groups[key]
+            elif buffered > window:
+                _, (_, members) = groups.popitem(last=False)
+            else:
+                continue
+            buffered -= len(members)
+            yield _group_item(members)
+        for _, members in groups.values():
+            yield _group_item(members)
+    finally:
+        reader.cancel()
+
+
+def split_usage(usage, k):
+    # 合并调用的用量平均分给 k 个请求，除不尽的部分给前面的请求
+    shares = [{} for _ in range(k)]
+    for name, value in (usage or {}).items():
+        if not isinstance(value, int):
+            continue
+        base, extra = divmod(value, k)
+        for i, share in enumerate(shares):
+            share[name] = base + (1 if i < extra else 0)
+    return shares
+
+
+def fan_out_samples(request_client):
+    """把合并后的 APIRequest 拆成每个原始请求各一份，第 i 个请求拿到第 i 个 choice。"""
+    members = request_client.metadata.members
+    response = request_client.response
+    if response is not None:
+        choices = sorted(response.get('choices', []),
+                         key=lambda choice: choice.get('index', 0))
+        usages = split_usage(response.get('usage'), len(members))
+    results = []
+    for i, (request_id, request_json, metadata) in enumerate(members):
+        member = copy.copy(request_client)
+        member.id = request_id if request_id is not None else uuid.uuid4()
+        member.request_json = request_json
+        member.metadata = metadata
+        if response is not None and i < len(choices):
+            member.response = dict(response,
+                                   choices=[dict(choices[i], index=0)],
+                                   usage=usages[i])
+        elif response is not None:
+            member.response = None
+            member.result = request_client.result + [
+                Exception(f'响应里只有{len(choices)}个 choice')
+            ]
+        results.append(member)
+    return results
 
 
 class MessageProcessor:
 
-    def __init__(self, session_configs):
+    def __init__(self,
+                 session_configs,
+                 pool=None,
+                 warm_up_connections=0,
+                 proxy_pool=None,
+                 retry_budget=None,
+                 max_deferrals=0,
+                 hedging=None,
+                 tenant_weights=None,
+                 max_queue_wait=None,
+                 cache=None,
+                 coalesce=True,
+                 coalesce_all=False):
         # 初始化 manager 和 status_tracker 作为类的属性
-        self.manager = SessionManager(session_configs)
+        # pool 用来调整共享连接池的 limit、keepalive 等参数
+        # tenant_weights 是 {租户: 权重}，多个租户共用 key 时按权重分配额度
+        self.manager = SessionManager(session_configs,
+                                      pool=pool or ConnectionPool(),
+                                      tenant_weights=tenant_weights or {})
         self.status_tracker = StatusTracker()
+        self.cool_off = CoolOffCoordinator(self.status_tracker)
+        # 不指定代理池时沿用原来的单个本地代理
+        self.proxy_pool = proxy_pool or ProxyPool([PROXY])
+        self.retry_budget = retry_budget or RetryBudget()
+        # 传入 HedgePolicy 后开启对冲请求，默认关闭
+        self.hedging = hedging
+        # 预计排队时间超过 max_queue_wait 秒时 execute/send_request 直接抛出 Overloaded，
+        # None 表示不限制（带 deadline 的请求仍然会检查能否在截止时间前拿到 key）
+        self.max_queue_wait = max_queue_wait
+        # 传入 ResponseCache 后，相同的请求直接用缓存里的响应
+        self.cache = cache
+        # execute/send_request 同时收到相同的请求体时只发送一次。
+        # 和 ResponseCache 一样默认只合并 temperature 为 0 的请求，采样请求各自独立发送；
+        # coalesce_all=True 时合并所有请求
+        self.coalesce = coalesce
+        self.coalesce_all = coalesce_all
+        self._in_flight = {}  # 请求体哈希 -> 正在处理的 task
+        # run() 中超出重试预算的请求最多推迟到队尾重新发送几次，0 表示直接失败
+        self.max_deferrals = max_deferrals
+        self.warm_up_connections = warm_up_connections
+        self._warm_up_task = None
+        self.reap_interval = 60  # 后台清理闲置会话的间隔（秒）
+        self._maintenance_task = None
+        self._accepting = True
+        self._active_tasks = set()
+        self._pending_retries = 0  # run() 中等待重试或被推迟、暂时不在处理的请求
+        self._run_tasks = set()  # run() 的 worker，shutdown 超时时一起取消
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def _update_idle(self):
+        if self._active_tasks or self._pending_retries:
+            self._idle.clear()
+        else:
+            self._idle.set()
+
+    def _start_maintenance(self):
+        if self._maintenance_task is None or self._maintenance_task.done():
+            self._maintenance_task = asyncio.create_task(self._maintain())
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(self.reap_interval)
+            try:
+                await self.manager.close_inactive_sessions()
+            except Exception as e:
+                logger.warning(f'清理闲置会话失败：{e}')
+
+    async def shutdown(self, drain_timeout=30):
+        """停止接收新请求，等正在处理的请求结束（最多 drain_timeout 秒），然后关闭连接。
+
+        超时后还没结束的请求会被取消。
+        """
+        self._accepting = False
+        try:
+            await asyncio.wait_for(self._idle.wait(), drain_timeout)
+        except asyncio.TimeoutError:
+            logger.warning(
+                f'{drain_timeout}秒内还有{len(self._active_tasks)}个请求没有结束，直接取消')
+            tasks = self._active_tasks | self._run_tasks
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if self._maintenance_task is not None:
+            self._maintenance_task.cancel()
+            self._maintenance_task = None
+        await self.manager.close_all_sessions()
+        if self.cache is not None:
+            self.cache.close()
+
+    async def warm_up(self):
+        """在第一次发送之前预热连接池，重复调用只会预热一次。
+
+        交互式使用时在启动阶段 await 一次，之后 send_request 就不会碰上冷启动。
+        """
+        if self.warm_up_connections <= 0 or self.manager.pool is None:
+            return
+        if self._warm_up_task is None:
+            # 预热的连接平均分给每个代理
+            proxies = self.proxy_pool.proxies
+            connections = max(1, self.warm_up_connections // len(proxies))
+            self._warm_up_task = asyncio.ensure_future(
+                asyncio.gather(*(self.manager.pool.warm_up(connections,
+                                                           proxy=proxy.url)
+                                 for proxy in proxies)))
+        await self._warm_up_task
+
+    async def _tracked(self, coro):
+        # 记录正在处理请求的 task，shutdown 时等它们结束
+        self._start_maintenance()
+        task = asyncio.current_task()
+        self._active_tasks.add(task)
+        self._idle.clear()
+        try:
+            return await coro
+        finally:
+            self._active_tasks.discard(task)
+            self._update_idle()
+
+    async def execute(self,
+                      data,
+                      request_id=None,
+                      metadata=None,
+                      deadline=None,
+                      priority=PRIORITY_INTERACTIVE,
+                      tenant=DEFAULT_TENANT):
+        """发送一个请求，返回完成后的 APIRequest（包含响应、错误、耗时和使用的 key）。
+
+        deadline 是 time.time() 时间戳，到时还没完成的请求会被放弃。
+        排队太久的请求不会被接受，而是抛出 Overloaded。
+        coalesce 打开时，和正在处理的请求体相同的确定性请求不再单独发送，而是等那一次调用的结果，
+        优先级以先发出的那个为准，每个调用方最多等到自己的截止时间。
+        """
+        if not self._coalescable(data):
+            self._admit(priority, deadline)
+            request_client = self._new_request(data, request_id, metadata,
+                                               deadline, priority, tenant)
+            await self._tracked(request_client.call_llm())
+        else:
+            request_client = await self._single_flight(data, request_id,
+                                                       metadata, deadline,
+                                                       priority, tenant)
+        logger.info(f'统计：{self.status_tracker}')
+        return request_client
+
+    def _coalescable(self, data):
+        return self.coalesce and (self.coalesce_all or is_deterministic(data))
+
+    async def _single_flight(self, data, request_id, metadata, deadline,
+                             priority, tenant):
+        key = request_cache_key(data)
+        leader = self._in_flight.get(key)
+        if leader is None:
+            self._admit(priority, deadline)
+            request_client = self._new_request(data, request_id, metadata,
+                                               deadline, priority, tenant)
+
+            async def call():
+                await self._tracked(request_client.call_llm())
+                return request_client
+
+            leader = asyncio.ensure_future(call())
+            self._in_flight[key] = leader
+            leader.add_done_callback(lambda _: self._in_flight.pop(key, None))
+            # 第一个调用方被取消时，请求继续为其他等待的调用方处理
+            return await asyncio.shield(leader)
+
+        # 跟随的调用方也是一个独立的请求：按自己的租户计数，最多等到自己的截止时间
+        request_client = self._new_request(data, request_id, metadata,
+                                           deadline, priority, tenant)
+        request_client.started = time.time()
+        request_client.coalesced = True
+        self.status_tracker.num_coalesced += 1
+        logger.debug('相同的请求正在处理，等待它的结果')
+        try:
+            leader_client = await asyncio.wait_for(asyncio.shield(leader),
+                                                   request_client.remaining())
+        except asyncio.TimeoutError:
+            request_client._expire()
+            return request_client
+        request_client.result = list(leader_client.result)
+        request_client.key_id = leader_client.key_id
+        if leader_client.response is not None:
+            request_client._succeed(leader_client.response)
+        else:
+            request_client.error_kind = leader_client.error_kind
+            request_client._fail()
+        return request_client
+
+    def _admit(self, priority, deadline):
+        limit = self.max_queue_wait
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                # 已经过了截止时间，不算过载，交给请求本身记为超时
+                return
+            limit = remaining if limit is None else min(limit, remaining)
+        if limit is None:
+            return
+        wait = self.manager.estimate_wait(priority)
+        if wait > limit:
+            self.status_tracker.num_rejected_overloaded += 1
+            logger.warning(f'预计排队{wait:.1f}秒，超过上限{limit:.1f}秒，拒绝请求')
+            raise Overloaded(
+                f'Estimated queue wait {wait:.1f}s exceeds {limit:.1f}s.',
+                wait)
 
-    async def send_request(self, data):
+    def _new_request(self,
+                     data,
+                     request_id=None,
+                     metadata=None,
+                     deadline=None,
+                     priority=PRIORITY_INTERACTIVE,
+                     tenant=DEFAULT_TENANT):
+        if not self._accepting:
+            raise RuntimeError('MessageProcessor is shutting down.')
         request_client = APIRequest(request_json=data,
                                     session_manager=self.manager,
-                                    status_tracker=self.status_tracker)
-        response = await request_client.call_llm()
-        logger.info(f'统计：{self.status_tracker}')
+                                    status_tracker=self.status_tracker,
+                                    cool_off=self.cool_off,
+                                    proxy_pool=self.proxy_pool,
+                                    retry_budget=self.retry_budget,
+                                    hedging=self.hedging,
+                                    deadline=deadline,
+                                    priority=priority,
+                                    tenant=tenant,
+                                    cache=self.cache,
+                                    metadata=metadata)
+        if request_id is not None:
+            request_client.id = request_id
+        self.status_tracker.num_tasks_started += 1
+        self.status_tracker.num_tasks_in_progress += 1
+        self.status_tracker.tenant(tenant).num_tasks_started += 1
+        return request_client
+
+    async def send_request(self,
+                           data,
+                           deadline=None,
+                           priority=PRIORITY_INTERACTIVE,
+                           tenant=DEFAULT_TENANT):
+        """发送一个请求并返回响应，失败或超过 deadline（time.time() 时间戳）时返回 None。
+
+        系统过载、预计排队时间超过上限时抛出 Overloaded。
+        """
+        request_client = await self.execute(data,
+                                            deadline=deadline,
+                                            priority=priority,
+                                            tenant=tenant)
+        response = request_client.response
         del request_client
         logger.info('request_client已删除')
         return response
 
+    async def run(self,
+                  source,
+                  concurrency=10,
+                  on_result=None,
+                  priority=PRIORITY_BATCH,
+                  tenant=DEFAULT_TENANT,
+                  max_n=1):
+        """用固定数量的 worker 处理 source 中的所有请求。
 
-# 配置session_configs
-with open('api keys.txt', 'r') as file:
-    api_keys = file.read().splitlines()
-session_configs = [{
-    "headers": {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
-} for api_key in api_keys]
+        source 可以是普通的或异步的可迭代对象，按需读取，放进一个有界队列，
+        所以同一时间内存里只有 concurrency 个左右的请求。
+        source 中的元素可以是请求体，也可以是 (request_id, 请求体) 或
+        (request_id, 请求体, metadata)。
+        每个请求完成后调用 on_result(request_client)，参数是完成后的 APIRequest，
+        on_result 可以是普通函数或协程函数。
+        因为重试预算用完而失败的请求会被推迟到队尾（队列空了之后）重新发送，
+        最多 max_deferrals 次。
+        默认按批量优先级等待 key，同时有 send_request 的在线请求时先让给它们。
+        shutdown() 之后不再读取新的输入，已经开始的请求（包括等待重试的）处理完后返回。
+        所有请求都记在 tenant 名下，和其他租户按权重分享 key。
+        max_n 大于 1 时，请求体相同的请求合并成一次 n=K 的调用（K 不超过 max_n），
+        on_result 仍然对每个原始请求各调用一次。
+        """
+        await self.warm_up()
+        if max_n > 1:
+            source = collapse_samples(source, max_n, window=concurrency * 100)
+        queue = asyncio.Queue(maxsize=concurrency * 2)
+        # 等待重试的请求按可以重试的时间排成小顶堆，worker 不会陪着请求一起等
+        delayed = []
+        max_delayed = concurrency * 4
+        sequence = count()
+        deferred = deque()
+        done = object()
+
+        async def produce():
+            # shutdown 之后不再读取新的输入
+            if hasattr(source, '__aiter__'):
+                async for data in source:
+                    if not self._accepting:
+                        break
+                    await queue.put(data)
+            else:
+                for data in source:
+                    if not self._accepting:
+                        break
+                    await queue.put(data)
+            for _ in range(concurrency):
+                await queue.put(done)
+
+        def park(entry, into=None):
+            self._pending_retries += 1
+            self._update_idle()
+            if into is None:
+                heapq.heappush(delayed, entry)
+            else:
+                into.append(entry)
+
+        def unpark(entry):
+            self._pending_retries -= 1
+            self._update_idle()
+            return entry
+
+        async def consume():
+            finished = False
+            while True:
+                now = time.time()
+                if delayed and delayed[0][0] <= now:
+                    _, _, request_client, deferrals = unpark(
+                        heapq.heappop(delayed))
+                elif deferred and (finished or queue.empty()):
+                    request_client, deferrals = unpark(deferred.popleft())
+                elif finished or len(delayed) >= max_delayed:
+                    # 输入读完了，或者等待重试的请求太多，先处理到期的重试
+                    if not delayed:
+                        return
+                    await asyncio.sleep(delayed[0][0] - now)
+                    continue
+                else:
+                    timeout = delayed[0][0] - now if delayed else None
+                    try:
+                        item = await asyncio.wait_for(queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        continue
+                    if item is done:
+                        # 收到结束标记后还要把重试和推迟的请求处理完
+                        finished = True
+                        continue
+                    if not self._accepting:
+                        # 已经读进队列但还没开始的请求直接丢弃，让 produce 尽快结束
+                        continue
+                    if not isinstance(item, tuple):
+                        item = (None, item)
+                    request_client = self._new_request(item[1],
+                                                       item[0],
+                                                       *item[2:],
+                                                       priority=priority,
+                                                       tenant=tenant)
+                    deferrals = 0
+
+                request_client.may_defer = deferrals < self.max_deferrals
+                if not await self._tracked(request_client.try_once()):
+                    if request_client.over_budget:
+                        # 超出重试预算，推迟到队尾重新发送，同一个请求不会被重复计数
+                        request_client.over_budget = False
+                        park((request_client, deferrals + 1), deferred)
+                        continue
+                    park((time.time() + request_client.retry_delay,
+                          next(sequence), request_client, deferrals))
+                    continue
+                logger.info(f'统计：{self.status_tracker}')
+                results = [request_client]
+                if isinstance(request_client.metadata, SampleGroup):
+                    results = fan_out_samples(request_client)
+                    self.status_tracker.num_samples_collapsed += len(
+                        results) - 1
+                if on_result is not None:
+                    for result_client in results:
+                        result = on_result(result_client)
+                        if asyncio.iscoroutine(result):
+                            await result
+
+        tasks = [asyncio.create_task(produce())]
+        tasks += [asyncio.create_task(consume()) for _ in range(concurrency)]
+        self._run_tasks.update(tasks)
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._run_tasks.difference_update(tasks)
+            # 被取消时留在 delayed/deferred 里的请求不再计入
+            self._pending_retries -= len(delayed) + len(deferred)
+            self._update_idle()
+
+
+async def read_jsonl(file_path, start_offset=0, start_line=0, chunk_size=1000):
+    """按行读取 JSONL，每次在线程里读 chunk_size 行，不阻塞事件循环，也不会把整个文件读进内存。
+
+    从字节偏移 start_offset（对应第 start_line 行之后）开始读，
+    产出 (行号, 起始偏移, 结束偏移, 原始行)，空行会被跳过，由调用方决定是否解析。
+    """
+    with open(file_path, 'rb') as file:
+        file.seek(start_offset)
+        offset, line_number = start_offset, start_line
+        while lines := await asyncio.to_thread(
+                lambda: list(islice(file, chunk_size))):
+            for line in lines:
+                line_number += 1
+                start, offset = offset, offset + len(line)
+                if line.strip():
+                    yield line_number, start, offset, line
+
+
+def truncate_partial_line(file_path, block_size=64 * 1024):
+    """截掉崩溃时写了一半、没有换行符的最后一行，否则之后追加的内容会直接接在它后面。
+
+    只从文件末尾往前读到上一个换行符，不会把整个文件读进内存。截断过时返回 True。
+    """
+    if not os.path.exists(file_path):
+        return False
+    with open(file_path, 'r+b') as file:
+        end = position = file.seek(0, os.SEEK_END)
+        while position > 0:
+            start = max(0, position - block_size)
+            file.seek(start)
+            block = file.read(position - start)
+            if position == end and block.endswith(b'\n'):
+                return False
+            newline = block.rfind(b'\n')
+            if newline >= 0:
+                file.truncate(start + newline + 1)
+                return True
+            position = start
+        if end:
+            # 整个文件只有不完整的一行
+            file.truncate(0)
+            return True
+        return False
+
+
+@dataclass
+class Checkpoint:
+    """只追加的检查点文件，每行记录一段已完成的输入：起始偏移、结束偏移、最后一行的行号和 id。
+
+    加载时把首尾相接的记录合并成区间，内存只和区间数有关。从偏移 0 开始的区间就是
+    可以直接 seek 过去的位置，其余零散完成的区间用二分查找判断是否跳过，不用重新解析输出文件。
+    加载后把文件压缩成每个区间一行，下次恢复不用重放整个日志。
+    """
+    file_path: str
+    resume_offset: int = field(default=0, init=False)
+    resume_line: int = field(default=0, init=False)
+    _starts: list = field(default_factory=list, init=False)
+    _ends: list = field(default_factory=list, init=False)
+
+    def load(self):
+        if not os.path.exists(self.file_path):
+            return
+        if truncate_partial_line(self.file_path):
+            logger.warning('检查点最后一行不完整，已截断')
+        runs = {}  # 起始偏移 -> (结束偏移, 最后一行的行号)
+        run_starts = {}  # 结束偏移 -> 起始偏移
+        num_lines = 0
+        with open(self.file_path, 'r', encoding='utf-8') as file:
+            for line in file:
+                num_lines += 1
+                entry = self.parse(line)
+                if entry is None:
+                    logger.warning(f'检查点中有无效的行，已忽略：{line!r}')
+                    continue
+                start, end, line_number = entry
+                if start in runs:
+                    continue
+                right = runs.pop(end, None)
+                if right is not None:
+                    del run_starts[right[0]]
+                    end, line_number = right
+                left = run_starts.pop(start, None)
+                if left is not None:
+                    del runs[left]
+                    start = left
+                runs[start] = (end, line_number)
+                run_starts[end] = start
+        self.resume_offset, self.resume_line = runs.pop(0, (0, 0))
+        self._starts = sorted(runs)
+        self._ends = [runs[start][0] for start in self._starts]
+        logger.info(
+            f'从检查点恢复：跳到第{self.resume_line}行之后（偏移{self.resume_offset}），'
+            f'后面另有{len(runs)}段已完成')
+        if num_lines > len(runs) + 1:
+            self._compact(runs)
+
+    def _compact(self, runs):
+        # 先写临时文件再替换，压缩到一半崩溃时原来的检查点仍然完整
+        tmp_path = f'{self.file_path}.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as file:
+            if self.resume_offset:
+                file.write(
+                    self.entry(0, self.resume_offset, self.resume_line, None))
+            for start in self._starts:
+                file.write(self.entry(start, *runs[start], None))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(tmp_path, self.file_path)
+
+    @staticmethod
+    def parse(line):
+        """解析一行检查点记录，返回 (起始偏移, 结束偏移, 行号)，格式不对时返回 None。"""
+        # 只有最后一行可能写坏，已经在加载前截掉了，这里不再逐行解析 id
+        parts = line.rstrip('\n').split('\t')
+        if len(parts) != 4:
+            return None
+        try:
+            return int(parts[0]), int(parts[1]), int(parts[2])
+        except ValueError:
+            return None
+
+    def is_done(self, offset):
+        i = bisect_right(self._starts, offset) - 1
+        return i >= 0 and offset < self._ends[i]
+
+    @staticmethod
+    def entry(start, end, line_number, request_id):
+        return f'{start}\t{end}\t{line_number}\t{json.dumps(request_id)}\n'
+
+
+@dataclass
+class JsonlSink:
+    """把结果按行追加写入 JSONL，攒够 flush_every 行后在线程里一次性写盘。
+
+    指定 checkpoint_path 时，每批结果落盘之后再追加对应的检查点记录，
+    崩溃时最多重复发送最后一批，不会丢结果。
+    """
+    file_path: str
+    flush_every: int = 100
+    checkpoint_path: str = None
+    _buffer: list = field(default_factory=list, init=False)
+    _checkpoint_buffer: list = field(default_factory=list, init=False)
+    _lock: asyncio.Lock = field(default_factory=asyncio.Lock, init=False)
+
+    async def write(self, record, checkpoint_entry=None):
+        self._buffer.append(json.dumps(record, ensure_ascii=False) + '\n')
+        if checkpoint_entry is not None:
+            self._checkpoint_buffer.append(checkpoint_entry)
+        if len(self._buffer) >= self.flush_every:
+            await self.flush()
+
+    async def flush(self):
+        async with self._lock:
+            lines, self._buffer = self._buffer, []
+            entries, self._checkpoint_buffer = self._checkpoint_buffer, []
+            if lines:
+                await asyncio.to_thread(self._append, lines, entries)
+
+    def _append(self, lines, entries):
+        with open(self.file_path, 'a', encoding='utf-8') as file:
+            file.writelines(lines)
+            file.flush()
+            os.fsync(file.fileno())
+        if self.checkpoint_path is not None and entries:
+            with open(self.checkpoint_path, 'a', encoding='utf-8') as file:
+                file.writelines(entries)
+                file.flush()
+                os.fsync(file.fileno())
+
+
+@dataclass
+class BatchRunner:
+    """流式处理 requests.jsonl 这样的批量请求文件，结果逐行追加到输出文件。
+
+    输入的每一行是一个请求体，也可以是 {"id": ..., "body": {...}} 的形式；
+    没有 id 时用行号作为 id。输出每行为
+    {id, request, response | error, latency, key_id}。
+    完成的请求记录在 checkpoint_path（默认是输出文件名加 .checkpoint），
+    中断后重新运行会跳过已完成的行。
+    失败的请求同样算作完成（错误写在输出里），重新运行不会重试它们；
+    需要重试时，把输出中带 error 的行挑出来作为新的输入。
+    """
+    processor: MessageProcessor
+    input_path: str
+    output_path: str
+    concurrency: int = 10
+    flush_every: int = 100
+    checkpoint_path: str = None
+    tenant: str = DEFAULT_TENANT
+    max_n: int = 1  # 大于 1 时相同的请求合并成一次 n<=max_n 的调用，默认不合并
+
+    def __post_init__(self):
+        if self.checkpoint_path is None:
+            self.checkpoint_path = f'{self.output_path}.checkpoint'
+
+    async def requests(self, checkpoint, sink):
+        async for line_number, start, end, line in read_jsonl(
+                self.input_path, checkpoint.resume_offset,
+                checkpoint.resume_line):
+            if checkpoint.is_done(start):
+                continue
+            request_id = line_number
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError('not a JSON object')
+                request_id = record.pop('id', line_number)
+                body = record.pop('body', record)
+                if not isinstance(body, dict):
+                    raise ValueError('body is not a JSON object')
+            except ValueError as e:
+                # 无效的行直接写一条错误记录，不影响其他行
+                logger.warning(f'第{line_number}行无效：{e}')
+                await sink.write(
+                    {
+                        'id': request_id,
+                        'error': f'invalid input line: {e}'
+                    }, Checkpoint.entry(start, end, line_number, request_id))
+                continue
+            yield request_id, body, (start, end, line_number)
+
+    async def run(self):
+        checkpoint = Checkpoint(self.checkpoint_path)
+        checkpoint.load()
+        # 输出先于检查点写入，半行结果对应的请求没有记进检查点，会重新发送
+        if truncate_partial_line(self.output_path):
+            logger.warning('输出文件最后一行不完整，已截断')
+        sink = JsonlSink(self.output_path, self.flush_every,
+                         self.checkpoint_path)
+
+        async def on_result(request_client):
+            await sink.write(
+                self.to_output(request_client),
+                Checkpoint.entry(*request_client.metadata, request_client.id))
+
+        try:
+            await self.processor.run(self.requests(checkpoint, sink),
+                                     concurrency=self.concurrency,
+                                     on_result=on_result,
+                                     tenant=self.tenant,
+                                     max_n=self.max_n)
+        finally:
+            await sink.flush()
+
+    @staticmethod
+    def to_output(request_client):
+        output = {
+            'id': request_client.id,
+            'request': request_client.request_json,
+        }
+        if request_client.response is not None:
+            output['response'] = request_client.response
+        elif not request_client.result:
+            output['error'] = 'unknown error'
+        elif isinstance(request_client.result[-1], dict):
+            # 接口返回的错误体原样保留
+            output['error'] = request_client.result[-1]
+        else:
+            output['error'] = str(request_client.result[-1])
+        output['latency'] = request_client.latency
+        output['key_id'] = str(request_client.key_id) if (
+            request_client.key_id) else None
+        return output
+
+
+# 配置session_configs，有 api_filter 标注过组织的 key 文件时优先使用
+if os.path.exists('new api keys.txt'):
+    session_configs = load_session_configs('new api keys.txt')
+else:
+    session_configs = load_session_configs('api keys.txt')
 
 # 创建 MessageProcessor 类的实例
 processor_instance = MessageProcessor(session_configs)
@@ -340,16 +2443,24 @@ async def main():
     }
 
     # 创建 MessageProcessor 类的实例
-    processor_instance = MessageProcessor(session_configs)
+    processor_instance = MessageProcessor(session_configs,
+                                          warm_up_connections=4)
 
     #开始执行··
-    tasks = [processor_instance.send_request(data) for _ in range(1)]
-    responses = await asyncio.gather(*tasks)
-    responses = [response for response in responses if response]
+    responses = []
+
+    def collect(request_client):
+        if request_client.response:
+            responses.append(request_client.response)
+
+    await processor_instance.run((data for _ in range(1)),
+                                 concurrency=1,
+                                 on_result=collect)
 
     print(responses)
     print(len(responses))
     print(processor_instance.status_tracker)
+    await processor_instance.shutdown()
 
 
 if __name__ == "__main__":